@@ -0,0 +1,40 @@
+"""
+Ko'rilgan e'lon ID'lari uchun xotiradagi Bloom filter.
+SQLite'ga murojaat qilishdan oldin tezkor tekshirish uchun.
+"""
+
+import math
+import hashlib
+import threading
+from typing import Iterable
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        capacity = max(1, capacity)
+        # m = -n * ln(p) / ln(2)^2, k = m/n * ln(2)
+        self.size = int(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self._lock = threading.Lock()
+
+    def _indexes(self, key: str):
+        # Double hashing: h1 + i*h2 (bitta blake2b digest'idan ikki 64-bit bo'lak)
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key: str):
+        with self._lock:
+            for idx in self._indexes(key):
+                self.bits[idx >> 3] |= 1 << (idx & 7)
+
+    def update(self, keys: Iterable[str]):
+        for key in keys:
+            self.add(key)
+
+    def __contains__(self, key: str) -> bool:
+        bits = self.bits
+        return all(bits[idx >> 3] & (1 << (idx & 7)) for idx in self._indexes(key))
@@ -2,21 +2,32 @@
 """
 OLX.uz e'lonlarini kuzatuvchi Telegram bot.
 Polling mode - HTTPS talab qilmaydi.
+WEBHOOK_URL berilsa - webhook mode (HTTPS reverse proxy orqali).
 """
 
 import os
-import re
-import json
+import hmac
+import html
+import hashlib
+import queue
 import sqlite3
 import threading
 import time
 import logging
-from typing import Optional, List
+from typing import Optional, List, Dict, Tuple
 from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import OrderedDict, defaultdict, namedtuple
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import httpx
+import orjson
 import requests
-from bs4 import BeautifulSoup
+from selectolax.lexbor import LexborHTMLParser
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from bloom_filter import BloomFilter
 
 # Logging
 logging.basicConfig(
@@ -24,40 +35,128 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
+# httpx har bir so'rovni INFO darajasida yozadi - journal to'lib ketmasin
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # Environment variables
 BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN", "")
+TG_BASE = f"https://api.telegram.org/bot{BOT_TOKEN}"
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").rstrip("/")  # masalan: https://example.com
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = "/tg/webhook"
+# Telegram har bir so'rovda X-Telegram-Bot-Api-Secret-Token sarlavhasida yuboradi
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()
 
 # Constants
 BASE_URL = "https://www.olx.uz"
 USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
 CHECK_INTERVAL = 180  # 3 daqiqa
+MAX_CHECK_INTERVAL = 600  # jim filterlar uchun eng uzun interval
+OLX_MAX_INFLIGHT = 4  # OLX'ga bir vaqtda ko'pi bilan shuncha so'rov
+TG_GLOBAL_RATE = 25  # xabar/s (Telegram limiti 30)
+TG_CHAT_INTERVAL = 1.0  # bitta chatga xabarlar orasidagi minimal vaqt (s)
+TG_SENDER_WORKERS = 8  # turli chatlarga parallel yuboruvchi thread'lar
+TG_MESSAGE_LIMIT = 4000  # Telegram limiti 4096, HTML teglar uchun zaxira bilan
+FETCH_CACHE_TTL = 45  # s - shu vaqt ichida bir URL qayta yuklanmaydi
+FETCH_CACHE_MAX = 1000
+MAX_PAGE_BYTES = 1_500_000  # OLX sahifalari ~250 KB, undan kattasi kesiladi
 DB_PATH = "/opt/olx-bot/olx_bot.db"
+BLOOM_CAPACITY = 400_000  # ~500 KB, 1% false positive
+SEEN_CACHE_SIZE = 50_000  # LRU keshdagi ko'rilgan ID'lar soni
+SEEN_RETENTION_DAYS = 60  # shuncha kun sahifada ko'rinmagan e'lonlar o'chiriladi
+PRUNE_INTERVAL = 24 * 3600  # kuniga bir marta
+
+# CSS selektorlar
+SEL_LD_JSON = 'script[type="application/ld+json"]'
+SEL_DETAIL_LI = 'li[data-testid]'
+SEL_DETAIL_P = 'p'
+
+# Yangi e'lon xabari shabloni (Telegram HTML)
+NEW_LISTING_TEMPLATE = (
+    "🆕 <b>Yangi e'lon!</b>\n\n"
+    "<b>{title}</b>\n\n"
+    "💰 {price}{location}{details}\n\n"
+    "🔗 <a href=\"{url}\">E'lonni ko'rish</a>"
+)
 
 
 # ============== Database ==============
 
+Filter = namedtuple('Filter', 'id chat_id url name')
+Listing = namedtuple('Listing', 'id title price url location')
+
+SEEN_LISTINGS_SCHEMA = """
+    CREATE TABLE {if_not_exists}{name} (
+        listing_id TEXT PRIMARY KEY,
+        title TEXT,
+        price TEXT,
+        url TEXT,
+        first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    ) WITHOUT ROWID
+"""
+
+# Bitta uzoq yashovchi ulanish (checker va polling thread'lari uchun umumiy)
+_conn: Optional[sqlite3.Connection] = None
+_db_lock = threading.RLock()
+
+# Ko'rilgan ID'lar uchun Bloom filter: "yo'q" javobi aniq, SQLite'ga bormaymiz
+seen_bloom: Optional[BloomFilter] = None
+
+# Tez-tez uchraydigan (sahifa boshidagi) ko'rilgan ID'lar uchun LRU kesh
+_seen_cache: "OrderedDict[str, None]" = OrderedDict()
+_seen_cache_lock = threading.Lock()
+
+
 @contextmanager
 def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    try:
-        yield conn
-    finally:
-        conn.close()
+    with _db_lock:
+        yield _conn
 
 
 def init_db():
+    global _conn, seen_bloom
+    _conn = sqlite3.connect(
+        DB_PATH,
+        check_same_thread=False,
+        isolation_level=None,
+        cached_statements=128  # IN (...) variantlari ham keshda qolishi uchun
+    )
+    _conn.row_factory = sqlite3.Row
+    _conn.execute("PRAGMA journal_mode=WAL")
+    _conn.execute("PRAGMA synchronous=NORMAL")
+    _conn.execute("PRAGMA temp_store=MEMORY")
+    _conn.execute("PRAGMA cache_size=-64000")  # ~64 MB page cache
+    _conn.execute("PRAGMA mmap_size=268435456")  # 256 MB memory-mapped I/O
+    # prune_seen_listings() bo'shagan sahifalarni qaytarishi uchun
+    if _conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        _conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        _conn.execute("VACUUM")
+
     with get_db() as conn:
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS seen_listings (
-                listing_id TEXT PRIMARY KEY,
-                title TEXT,
-                price TEXT,
-                url TEXT,
-                first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+        # WITHOUT ROWID: qatorlar to'g'ridan-to'g'ri PK B-tree'da (alohida index yo'q)
+        conn.execute(SEEN_LISTINGS_SCHEMA.format(if_not_exists="IF NOT EXISTS ", name="seen_listings"))
+        schema = conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'seen_listings'"
+        ).fetchone()[0]
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(seen_listings)")}
+        if "WITHOUT ROWID" not in schema.upper() or "last_seen" not in columns:
+            # Eski jadvalni WITHOUT ROWID + last_seen ko'rinishiga ko'chirish
+            # (ADD COLUMN CURRENT_TIMESTAMP default'ini qabul qilmaydi, shuning uchun qayta quramiz)
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(SEEN_LISTINGS_SCHEMA.format(if_not_exists="", name="seen_listings_new"))
+                conn.execute("""
+                    INSERT INTO seen_listings_new (listing_id, title, price, url, first_seen, last_seen)
+                    SELECT listing_id, title, price, url, first_seen, first_seen FROM seen_listings
+                """)
+                conn.execute("DROP TABLE seen_listings")
+                conn.execute("ALTER TABLE seen_listings_new RENAME TO seen_listings")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            logger.info("seen_listings yangi sxemaga ko'chirildi")
         conn.execute("""
             CREATE TABLE IF NOT EXISTS filter_urls (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -68,21 +167,48 @@ def init_db():
                 UNIQUE(chat_id, url)
             )
         """)
-        conn.commit()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS meta (
+                k TEXT PRIMARY KEY,
+                v TEXT
+            )
+        """)
+        # get_filters: WHERE chat_id = ? ORDER BY id DESC uchun saralashsiz index
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_filter_urls_chat_id ON filter_urls(chat_id, id DESC)")
+        conn.execute("DROP INDEX IF EXISTS idx_seen_first_seen")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_seen_last_seen ON seen_listings(last_seen)")
+        conn.execute("ANALYZE")
+
+        count = conn.execute("SELECT COUNT(*) FROM seen_listings").fetchone()[0]
+        seen_bloom = BloomFilter(max(BLOOM_CAPACITY, count * 2))
+        seen_bloom.update(row[0] for row in conn.execute("SELECT listing_id FROM seen_listings"))
     logger.info("Database initialized")
 
 
+def get_meta(key: str) -> Optional[str]:
+    with get_db() as conn:
+        row = conn.execute("SELECT v FROM meta WHERE k = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+
+def set_meta(key: str, value: str):
+    with get_db() as conn:
+        conn.execute(
+            "INSERT INTO meta (k, v) VALUES (?, ?) ON CONFLICT(k) DO UPDATE SET v = excluded.v",
+            (key, value)
+        )
+
+
 def add_filter(chat_id: str, url: str, name: str = None) -> dict:
-    try:
-        with get_db() as conn:
-            cursor = conn.execute(
-                "INSERT INTO filter_urls (chat_id, url, name) VALUES (?, ?, ?)",
-                (chat_id, url, name)
-            )
-            conn.commit()
-            return {"success": True, "id": cursor.lastrowid}
-    except sqlite3.IntegrityError:
-        return {"success": False, "error": "Bu filter allaqachon qo'shilgan"}
+    with get_db() as conn:
+        row = conn.execute(
+            "INSERT INTO filter_urls (chat_id, url, name) VALUES (?, ?, ?) "
+            "ON CONFLICT(chat_id, url) DO NOTHING RETURNING id",
+            (chat_id, url, name)
+        ).fetchone()
+    if row:
+        return {"success": True, "id": row[0]}
+    return {"success": False, "error": "Bu filter allaqachon qo'shilgan"}
 
 
 def remove_filter(chat_id: str, filter_id: int) -> bool:
@@ -91,69 +217,228 @@ def remove_filter(chat_id: str, filter_id: int) -> bool:
             "DELETE FROM filter_urls WHERE id = ? AND chat_id = ?",
             (filter_id, chat_id)
         )
-        conn.commit()
         return cursor.rowcount > 0
 
 
-def get_filters(chat_id: str) -> List[dict]:
+def get_filters(chat_id: str) -> List[Filter]:
     with get_db() as conn:
         cursor = conn.execute(
-            "SELECT id, url, name, created_at FROM filter_urls WHERE chat_id = ? ORDER BY id DESC",
+            "SELECT id, chat_id, url, name FROM filter_urls WHERE chat_id = ? ORDER BY id DESC",
             (chat_id,)
         )
-        return [dict(row) for row in cursor.fetchall()]
+        return [Filter(*row) for row in cursor]
 
 
-def get_all_filters() -> List[dict]:
+def get_all_filters() -> List[Filter]:
     with get_db() as conn:
-        cursor = conn.execute("SELECT chat_id, url FROM filter_urls")
-        return [dict(row) for row in cursor.fetchall()]
+        cursor = conn.execute("SELECT id, chat_id, url, name FROM filter_urls")
+        return [Filter(*row) for row in cursor]
+
+
+def _remember_seen(listing_ids):
+    """Tasdiqlangan ko'rilgan ID'larni LRU keshga qo'shish."""
+    with _seen_cache_lock:
+        for listing_id in listing_ids:
+            _seen_cache[listing_id] = None
+            _seen_cache.move_to_end(listing_id)
+        while len(_seen_cache) > SEEN_CACHE_SIZE:
+            _seen_cache.popitem(last=False)
+
+
+def _touch_seen(conn: sqlite3.Connection, listing_ids: List[str]):
+    """Hali sahifada turgan e'lonlarning last_seen'ini yangilash (prune o'chirmasligi uchun)."""
+    # Kuniga ko'pi bilan bir marta yoziladi - qolgan chaqiruvlar faqat PK bo'yicha o'qish
+    for i in range(0, len(listing_ids), 900):
+        chunk = listing_ids[i:i + 900]
+        placeholders = ",".join("?" * len(chunk))
+        conn.execute(
+            f"UPDATE seen_listings SET last_seen = CURRENT_TIMESTAMP "
+            f"WHERE listing_id IN ({placeholders}) AND last_seen < datetime('now', '-1 day')",
+            chunk
+        )
 
 
-def is_seen(listing_id: str) -> bool:
+def get_seen_ids(listing_ids: List[str]) -> set:
+    """Berilgan ID'lardan allaqachon ko'rilganlarini bitta so'rovda olish."""
+    # Avval LRU kesh, keyin Bloom filter: faqat "ehtimol ko'rilgan" qolganlari SQLite'da tekshiriladi
+    with _seen_cache_lock:
+        seen = {listing_id for listing_id in listing_ids if listing_id in _seen_cache}
+    listing_ids = [
+        listing_id for listing_id in listing_ids
+        if listing_id not in seen and listing_id in seen_bloom
+    ]
+    found = set()
     with get_db() as conn:
-        cursor = conn.execute(
-            "SELECT 1 FROM seen_listings WHERE listing_id = ?",
-            (listing_id,)
-        )
-        return cursor.fetchone() is not None
+        # SQLite parametrlar limiti (999) uchun bo'laklarga bo'lish
+        for i in range(0, len(listing_ids), 900):
+            chunk = listing_ids[i:i + 900]
+            placeholders = ",".join("?" * len(chunk))
+            cursor = conn.execute(
+                f"SELECT listing_id FROM seen_listings WHERE listing_id IN ({placeholders})",
+                chunk
+            )
+            found.update(row[0] for row in cursor)
+        _touch_seen(conn, list(seen | found))
+    _remember_seen(found)
+    return seen | found
 
 
-def mark_seen(listing_id: str, title: str, price: str, url: str):
+def mark_seen_many(rows: List[tuple]):
+    """(listing_id, title, price, url) qatorlarini bitta tranzaksiyada yozish."""
+    if not rows:
+        return
     with get_db() as conn:
-        conn.execute(
-            "INSERT OR IGNORE INTO seen_listings (listing_id, title, price, url) VALUES (?, ?, ?, ?)",
-            (listing_id, title, price, url)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT OR IGNORE INTO seen_listings (listing_id, title, price, url) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    seen_bloom.update(row[0] for row in rows)
+    _remember_seen(row[0] for row in rows)
+
+
+def claim_listings(rows: List[tuple]) -> set:
+    """Qatorlarni yozish va haqiqatan yangi qo'shilgan ID'larni qaytarish."""
+    # RETURNING tekshirish va yozishni birlashtiradi - parallel filterlar
+    # bitta e'lonni ikki marta yubormaydi
+    if not rows:
+        return set()
+    claimed = set()
+    with get_db() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for row in rows:
+                cursor = conn.execute(
+                    "INSERT INTO seen_listings (listing_id, title, price, url) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(listing_id) DO NOTHING RETURNING listing_id",
+                    row
+                )
+                inserted = cursor.fetchone()
+                if inserted:
+                    claimed.add(inserted[0])
+            _touch_seen(conn, [row[0] for row in rows if row[0] not in claimed])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    seen_bloom.update(claimed)
+    _remember_seen(claimed)
+    return claimed
+
+
+def prune_seen_listings() -> int:
+    """SEEN_RETENTION_DAYS kun davomida ko'rinmagan e'lonlarni o'chirish."""
+    with get_db() as conn:
+        cursor = conn.execute(
+            "DELETE FROM seen_listings WHERE last_seen < datetime('now', ?)",
+            (f"-{SEEN_RETENTION_DAYS} days",)
         )
-        conn.commit()
+        deleted = cursor.rowcount
+        # execute() statement'ni bir marta qadamlaydi (= bitta sahifa); executescript oxirigacha bajaradi
+        conn.executescript("PRAGMA incremental_vacuum;")
+        return deleted
 
 
 # ============== OLX Scraper ==============
 
 class OLXScraper:
     def __init__(self):
-        self.session = requests.Session()
-        self.session.headers.update({"User-Agent": USER_AGENT})
+        # HTTP/2: bir nechta so'rov bitta TLS ulanishda multiplex qilinadi
+        self.session = httpx.Client(
+            http2=True,
+            headers={
+                "User-Agent": USER_AGENT,
+                "Accept": "text/html,application/xhtml+xml",
+                # br uchun brotli paketi kerak (httpx uni avtomatik ochadi)
+                "Accept-Encoding": "gzip, br"
+            },
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+            timeout=30.0,
+            follow_redirects=True
+        )
+        self._slots = threading.BoundedSemaphore(OLX_MAX_INFLIGHT)
+        # Conditional GET uchun: URL -> (ETag, Last-Modified) va oxirgi natija
+        self._validators: Dict[str, Tuple[Optional[str], Optional[str]]] = {}
+        self._last_listings: Dict[str, List[Listing]] = {}
+        # Qisqa muddatli kesh: URL -> (vaqt, e'lonlar)
+        self._fetch_cache: Dict[str, Tuple[float, List[Listing]]] = {}
+
+    def _get(self, url: str, timeout: int, headers: Optional[dict] = None) -> Tuple[httpx.Response, bytes]:
+        """OLX'ga so'rov (bir vaqtdagi so'rovlar soni va javob hajmi cheklangan)."""
+        with self._slots:
+            with self.session.stream("GET", url, timeout=timeout, headers=headers) as response:
+                chunks = []
+                size = 0
+                for chunk in response.iter_bytes():
+                    chunks.append(chunk)
+                    size += len(chunk)
+                    if size >= MAX_PAGE_BYTES:
+                        logger.warning(f"Sahifa {MAX_PAGE_BYTES} baytda kesildi: {url}")
+                        break
+                return response, b"".join(chunks)[:MAX_PAGE_BYTES]
 
     def extract_listing_id(self, url: str) -> Optional[str]:
-        match = re.search(r'-ID([a-zA-Z0-9]+)\.html', url)
-        return match.group(1) if match else None
+        # URL har doim "...-ID<id>.html" ko'rinishida - regex o'rniga kesib olamiz
+        start = url.rfind('-ID')
+        end = url.rfind('.html')
+        if 0 < start < end:
+            listing_id = url[start + 3:end]
+            if listing_id.isascii() and listing_id.isalnum():
+                return listing_id
+        return None
+
+    def _cache_listings(self, filter_url: str, listings: List[Listing]):
+        now = time.monotonic()
+        if len(self._fetch_cache) >= FETCH_CACHE_MAX:
+            for url, (cached_at, _) in list(self._fetch_cache.items()):
+                if now - cached_at >= FETCH_CACHE_TTL:
+                    self._fetch_cache.pop(url, None)
+        self._fetch_cache[filter_url] = (now, listings)
+
+    def forget_stale(self, active_urls):
+        """O'chirilgan filterlarning ETag va oxirgi natijalarini tozalash."""
+        for url in list(self._validators):
+            if url not in active_urls:
+                self._validators.pop(url, None)
+                self._last_listings.pop(url, None)
+
+    def fetch_listings(self, filter_url: str) -> List[Listing]:
+        cached_at, cached = self._fetch_cache.get(filter_url, (0.0, None))
+        if cached is not None and time.monotonic() - cached_at < FETCH_CACHE_TTL:
+            return cached
+
+        headers = {}
+        etag, last_modified = self._validators.get(filter_url, (None, None))
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
 
-    def fetch_listings(self, filter_url: str) -> list:
         try:
-            response = self.session.get(filter_url, timeout=30)
+            response, body = self._get(filter_url, timeout=30, headers=headers)
+            # 304 - sahifa o'zgarmagan, parse qilmasdan oldingi natijani qaytaramiz
+            # (forget_stale boshqa thread'da tozalashi mumkin - bir marta o'qiymiz)
+            last_listings = self._last_listings.get(filter_url)
+            if response.status_code == 304 and last_listings is not None:
+                self._cache_listings(filter_url, last_listings)
+                return last_listings
             response.raise_for_status()
-        except requests.RequestException as e:
+        except (httpx.HTTPError, httpx.InvalidURL) as e:
             logger.error(f"OLX error: {e}")
             return []
 
-        soup = BeautifulSoup(response.text, 'html.parser')
+        tree = LexborHTMLParser(body)
         listings = []
 
         # JSON-LD dan asosiy ma'lumotlarni olish
-        for script in soup.select('script[type="application/ld+json"]'):
+        for script in tree.css(SEL_LD_JSON):
             try:
-                data = json.loads(script.string)
+                data = orjson.loads(script.text())
 
                 if isinstance(data, dict) and data.get('@type') == 'ItemList':
                     for item in data.get('itemListElement', []):
@@ -170,7 +455,7 @@ class OLXScraper:
                                     try:
                                         price_num = int(float(price_raw))
                                         price = f"{price_num:,}".replace(',', ' ') + f" {currency}"
-                                    except:
+                                    except (TypeError, ValueError, OverflowError):
                                         price = "Kelishiladi"
                                 else:
                                     price = "Kelishiladi"
@@ -178,84 +463,121 @@ class OLXScraper:
                                 # Joylashuv
                                 area_served = offer.get('areaServed', {})
                                 if isinstance(area_served, dict):
-                                    location = area_served.get('name', '')
+                                    location = area_served.get('name')
                                 else:
-                                    location = str(area_served) if area_served else ''
-
-                                listings.append({
-                                    "id": listing_id,
-                                    "title": offer.get('name', 'E\'lon'),
-                                    "price": price,
-                                    "url": url,
-                                    "location": location,
-                                    "details": []
-                                })
-
-            except (json.JSONDecodeError, TypeError, KeyError) as e:
+                                    location = area_served
+
+                                # null yoki satr bo'lmagan qiymatlar format_listing'da html.escape'ni buzmasin
+                                listings.append(Listing(
+                                    listing_id,
+                                    str(offer.get('name') or 'E\'lon'),
+                                    price,
+                                    url,
+                                    str(location or '')
+                                ))
+
+            except (orjson.JSONDecodeError, TypeError, KeyError) as e:
                 logger.warning(f"JSON-LD parse error: {e}")
                 continue
 
         logger.info(f"{len(listings)} ta e'lon topildi")
-        return listings
 
-    def fetch_listing_details(self, url: str) -> list:
-        """E'lonning batafsil sahifasidan qo'shimcha ma'lumotlarni olish."""
-        try:
-            response = self.session.get(url, timeout=15)
-            response.raise_for_status()
-        except:
-            return []
-
-        soup = BeautifulSoup(response.text, 'html.parser')
-        details = []
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if etag or last_modified:
+            self._validators[filter_url] = (etag, last_modified)
+            self._last_listings[filter_url] = listings
+        self._cache_listings(filter_url, listings)
+        return listings
 
+    def _iter_details(self, tree: LexborHTMLParser):
+        """Batafsil ma'lumotlarni ketma-ket qaytarish (kerakligicha o'qiladi)."""
         # JSON-LD dan Product ma'lumotlari
-        for script in soup.select('script[type="application/ld+json"]'):
+        for script in tree.css(SEL_LD_JSON):
             try:
-                data = json.loads(script.string)
-                if isinstance(data, dict) and data.get('@type') == 'Product':
-                    # Description
-                    desc = data.get('description', '')
-                    if desc:
-                        # Qisqartirish
-                        desc = desc[:200] + '...' if len(desc) > 200 else desc
-                        details.append(desc)
-            except:
+                data = orjson.loads(script.text())
+            except orjson.JSONDecodeError:
                 continue
 
+            if isinstance(data, dict) and data.get('@type') == 'Product':
+                # Description
+                desc = data.get('description', '')
+                if isinstance(desc, str) and desc:
+                    # Qisqartirish
+                    desc = desc[:200] + '...' if len(desc) > 200 else desc
+                    yield desc
+
         # HTML dan parametrlarni olish
         # li elementlardan
-        for li in soup.select('li[data-testid]'):
-            text = li.get_text(strip=True)
+        for li in tree.css(SEL_DETAIL_LI):
+            text = li.text(strip=True)
             if text and len(text) < 100:
-                details.append(text)
+                yield text
 
         # p elementlardan (parametr nomlari bilan)
-        for p in soup.select('p'):
-            text = p.get_text(strip=True)
+        for p in tree.css(SEL_DETAIL_P):
+            text = p.text(strip=True)
             if ':' in text and len(text) < 80:
-                details.append(text)
+                yield text
 
-        # Takrorlarni olib tashlash
-        seen = set()
-        unique_details = []
-        for d in details:
-            if d not in seen:
-                seen.add(d)
-                unique_details.append(d)
+    def fetch_listing_details(self, url: str) -> list:
+        """E'lonning batafsil sahifasidan qo'shimcha ma'lumotlarni olish."""
+        try:
+            response, body = self._get(url, timeout=15)
+            response.raise_for_status()
+        except (httpx.HTTPError, httpx.InvalidURL):
+            return []
+
+        tree = LexborHTMLParser(body)
 
-        return unique_details[:8]
+        # Takrorlarsiz birinchi 8 tasi (tartib saqlanadi); yetarli bo'lgach qolgan tugunlar o'qilmaydi
+        details = {}
+        for text in self._iter_details(tree):
+            details[text] = None
+            if len(details) >= 8:
+                break
+        return list(details)
 
 
 scraper = OLXScraper()
 
+# Telegram API uchun keep-alive session
+tg_session = requests.Session()
+tg_session.headers["Content-Type"] = "application/json"
+tg_session.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.3,
+        # 429 bu yerda emas, telegram_sender_loop'da retry_after bilan qayta ishlanadi
+        status_forcelist=[500, 502, 503, 504],
+        # POST (sendMessage) qayta yuborilmaydi: javob kelmasa ham xabar yetib borgan bo'lishi mumkin
+        allowed_methods=["GET"],
+        raise_on_status=False
+    )
+))
+
 
 # ============== Telegram ==============
 
-def send_telegram(chat_id: str, text: str) -> bool:
+# Checker'dan keladigan xabarlar navbati: (chat_id, [text, ...]) - bitta chat uchun bitta element
+send_queue: "queue.Queue[Tuple[str, List[str]]]" = queue.Queue()
+
+# Barcha sender worker'lar uchun umumiy TG_GLOBAL_RATE limiti
+_global_send_lock = threading.Lock()
+_last_global_send = 0.0
+
+# Bitta chatga faqat bitta worker yuboradi: tartib va TG_CHAT_INTERVAL navbat elementlari orasida ham saqlanadi
+_chat_locks: Dict[str, threading.Lock] = defaultdict(threading.Lock)
+_chat_locks_lock = threading.Lock()
+_last_chat_send: Dict[str, float] = {}
+
+
+def _send_message(chat_id: str, text: str) -> Optional[requests.Response]:
     try:
-        response = requests.post(
-            f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage",
+        return tg_session.post(
+            f"{TG_BASE}/sendMessage",
             json={
                 "chat_id": chat_id,
                 "text": text,
@@ -264,10 +586,56 @@ def send_telegram(chat_id: str, text: str) -> bool:
             },
             timeout=30
         )
-        return response.ok
     except Exception as e:
         logger.error(f"Telegram error: {e}")
-        return False
+        return None
+
+
+def send_telegram(chat_id: str, text: str) -> bool:
+    response = _send_message(chat_id, text)
+    return response is not None and response.ok
+
+
+def _wait_global_slot():
+    global _last_global_send
+    with _global_send_lock:
+        wait = _last_global_send + 1 / TG_GLOBAL_RATE - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        _last_global_send = time.monotonic()
+
+
+def telegram_sender_loop():
+    """Navbatdagi chat xabarlarini ketma-ket yuborish; 429 da retry_after kutiladi."""
+    while True:
+        chat_id, texts = send_queue.get()
+        with _chat_locks_lock:
+            chat_lock = _chat_locks[chat_id]
+        try:
+            with chat_lock:
+                for text in texts:
+                    # Bitta chatga TG_CHAT_INTERVAL dan tez yubormaslik
+                    wait = _last_chat_send.get(chat_id, 0.0) + TG_CHAT_INTERVAL - time.monotonic()
+                    if wait > 0:
+                        time.sleep(wait)
+                    for attempt in range(5):
+                        _wait_global_slot()
+                        response = _send_message(chat_id, text)
+                        # Oxirgi urinishdan keyin retry_after kutish foydasiz
+                        if response is None or response.status_code != 429 or attempt == 4:
+                            break
+                        try:
+                            retry_after = response.json()["parameters"]["retry_after"]
+                        except (ValueError, KeyError, TypeError):
+                            retry_after = 5
+                        logger.warning(f"Telegram 429: {retry_after}s kutilmoqda")
+                        time.sleep(retry_after)
+                    _last_chat_send[chat_id] = time.monotonic()
+                    if response is None or not response.ok:
+                        status = response.status_code if response is not None else "no response"
+                        logger.error(f"Xabar yuborilmadi (chat {chat_id}): {status}")
+        finally:
+            send_queue.task_done()
 
 
 def handle_message(chat_id: str, text: str):
@@ -306,13 +674,13 @@ def handle_message(chat_id: str, text: str):
     elif text == '/list':
         filters = get_filters(chat_id)
         if filters:
-            msg = "📋 <b>Sizning filterlaringiz:</b>\n\n"
+            parts = ["📋 <b>Sizning filterlaringiz:</b>\n\n"]
             for f in filters:
-                short_url = f['url'][:50] + "..." if len(f['url']) > 50 else f['url']
-                name = f['name'] or f"Filter #{f['id']}"
-                msg += f"<b>ID: {f['id']}</b> - {name}\n{short_url}\n\n"
-            msg += "O'chirish: /remove [id]"
-            send_telegram(chat_id, msg)
+                short_url = f.url[:50] + "..." if len(f.url) > 50 else f.url
+                name = f.name or f"Filter #{f.id}"
+                parts.append(f"<b>ID: {f.id}</b> - {name}\n{short_url}\n\n")
+            parts.append("O'chirish: /remove [id]")
+            send_telegram(chat_id, "".join(parts))
         else:
             send_telegram(chat_id, "📭 Hozircha filter yo'q.\n\nOLX.uz dan URL yuboring.")
 
@@ -350,13 +718,22 @@ def add_filter_url(chat_id: str, url: str):
         send_telegram(chat_id, "❌ Faqat OLX.uz havolalari qabul qilinadi.")
         return
 
+    # Yaroqsiz URL (masalan, yangi qatorli matn) bazaga tushib, har siklda xato bermasin
+    try:
+        httpx.URL(url)
+    except httpx.InvalidURL:
+        send_telegram(chat_id, "❌ Havola noto'g'ri. Faqat OLX.uz havolasini yuboring.")
+        return
+
     result = add_filter(chat_id, url)
     if result["success"]:
         send_telegram(chat_id, "⏳ Filter qo'shilmoqda...")
         # Mark existing listings as seen
         listings = scraper.fetch_listings(url)
-        for listing in listings:
-            mark_seen(listing['id'], listing['title'], listing['price'], listing['url'])
+        mark_seen_many([
+            (listing.id, listing.title, listing.price, listing.url)
+            for listing in listings
+        ])
         send_telegram(chat_id, f"✅ Filter qo'shildi!\n\n{len(listings)} ta mavjud e'lon o'tkazib yuborildi.\nYangi e'lonlar haqida xabar beraman.")
     else:
         send_telegram(chat_id, f"⚠️ {result.get('error', 'Xatolik')}")
@@ -364,83 +741,189 @@ def add_filter_url(chat_id: str, url: str):
 
 # ============== Polling ==============
 
+def handle_update(update: dict):
+    """Telegram update'ni qayta ishlash (polling va webhook uchun umumiy)."""
+    message = update.get("message")
+    if not message:
+        return
+
+    text = message.get("text")
+    if text:
+        chat_id = str(message["chat"]["id"])
+        logger.info(f"Message from {chat_id}: {text[:50]}")
+        handle_message(chat_id, text)
+
+
 def polling_loop():
     """Get updates from Telegram using long polling."""
     logger.info("Polling started")
-    last_update_id = 0
+    # Restartdan keyin eski update'lar qayta kelmasligi uchun saqlangan offset
+    last_update_id = int(get_meta('last_update_id') or 0)
 
     while True:
         try:
-            response = requests.get(
-                f"https://api.telegram.org/bot{BOT_TOKEN}/getUpdates",
-                params={"offset": last_update_id + 1, "timeout": 30},
-                timeout=35
+            response = tg_session.get(
+                f"{TG_BASE}/getUpdates",
+                params={
+                    "offset": last_update_id + 1,
+                    "timeout": 50,
+                    "limit": 100,
+                    # Faqat xabarlar kerak - boshqa update turlari serverda filtrlanadi
+                    "allowed_updates": '["message"]'
+                },
+                timeout=55
             )
 
             if response.ok:
-                data = response.json()
+                data = orjson.loads(response.content)
                 for update in data.get("result", []):
                     last_update_id = update["update_id"]
-
-                    if "message" in update:
-                        message = update["message"]
-                        chat_id = str(message["chat"]["id"])
-                        text = message.get("text", "")
-
-                        if text:
-                            logger.info(f"Message from {chat_id}: {text[:50]}")
-                            handle_message(chat_id, text)
+                    handle_update(update)
+                    set_meta('last_update_id', str(last_update_id))
 
         except Exception as e:
             logger.error(f"Polling error: {e}")
             time.sleep(5)
 
 
+# ============== Webhook ==============
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        secret = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        # Sarlavhalar latin-1 da o'qiladi; str'dagi non-ASCII compare_digest'da TypeError beradi
+        if not hmac.compare_digest(secret.encode('latin-1'), WEBHOOK_SECRET.encode()):
+            self.send_response(403)
+            self.end_headers()
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            update = orjson.loads(self.rfile.read(length))
+        except (ValueError, orjson.JSONDecodeError):
+            self.send_response(400)
+            self.end_headers()
+            return
+
+        # Telegram'ga darhol 200 qaytaramiz, keyin qayta ishlaymiz
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+        try:
+            handle_update(update)
+        except Exception as e:
+            logger.error(f"Webhook error: {e}")
+
+    def log_message(self, format, *args):
+        # Standart stderr log'ini o'chirish
+        pass
+
+
+def webhook_loop():
+    """Telegram update'larini webhook orqali qabul qilish."""
+    response = tg_session.post(
+        f"{TG_BASE}/setWebhook",
+        json={
+            "url": f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+            "secret_token": WEBHOOK_SECRET,
+            "allowed_updates": ["message"]
+        },
+        timeout=30
+    )
+    if not response.ok:
+        logger.error(f"setWebhook error: {response.text}")
+        return
+
+    server = ThreadingHTTPServer(("0.0.0.0", WEBHOOK_PORT), WebhookHandler)
+    logger.info(f"Webhook started on port {WEBHOOK_PORT}")
+    server.serve_forever()
+
+
 # ============== Checker ==============
 
-def process_single_filter(chat_id: str, url: str):
-    """Bitta filterni tekshirish (parallel uchun)."""
+# Filterlar va e'lon tafsilotlari uchun alohida pool'lar
+# (ichma-ich submit qilinganda deadlock bo'lmasligi uchun)
+_filter_pool = ThreadPoolExecutor(max_workers=16)
+_detail_pool = ThreadPoolExecutor(max_workers=OLX_MAX_INFLIGHT)
+
+# Adaptiv interval: yangi e'lon chiqmagan filter har safar 2 baravar kamroq tekshiriladi
+_url_interval: Dict[str, float] = {}
+_next_check_at: Dict[str, float] = {}
+
+
+def fetch_details_safe(url: str) -> list:
+    try:
+        return scraper.fetch_listing_details(url)
+    except Exception as e:
+        logger.warning(f"Detail fetch error: {e}")
+        return []
+
+
+def format_listing(listing: Listing, details: list) -> str:
+    """Yangi e'lon xabarini tuzish (o'zgarmas qismlar shablonda)."""
+    location = f"\n📍 {html.escape(listing.location)}" if listing.location else ""
+    # Qo'shimcha ma'lumotlar
+    extra = "".join(f"\n• {html.escape(detail)}" for detail in details[:6])
+    return NEW_LISTING_TEMPLATE.format(
+        title=html.escape(listing.title),
+        price=html.escape(listing.price),
+        location=location,
+        details=f"\n{extra}" if extra else "",
+        url=html.escape(listing.url, quote=True)
+    )
+
+
+def process_single_filter(url: str) -> List[str]:
+    """Bitta filter URL'ni tekshirish, yangi e'lonlar xabarlarini qaytarish (parallel uchun)."""
     try:
         listings = scraper.fetch_listings(url)
-        new_count = 0
-
-        for listing in listings:
-            if not is_seen(listing['id']):
-                # Yangi e'lon! Batafsil ma'lumot olish
-                try:
-                    details = scraper.fetch_listing_details(listing['url'])
-                    listing['details'] = details
-                except Exception as e:
-                    logger.warning(f"Detail fetch error: {e}")
-                    listing['details'] = []
-
-                # Xabar tuzish
-                lines = [
-                    f"🆕 <b>Yangi e'lon!</b>\n",
-                    f"<b>{listing['title']}</b>\n",
-                    f"💰 {listing['price']}"
-                ]
-
-                if listing.get('location'):
-                    lines.append(f"📍 {listing['location']}")
-
-                # Qo'shimcha ma'lumotlar
-                if listing.get('details'):
-                    lines.append("")  # Bo'sh qator
-                    for detail in listing['details'][:6]:
-                        lines.append(f"• {detail}")
-
-                lines.append(f"\n🔗 <a href=\"{listing['url']}\">E'lonni ko'rish</a>")
-                message = "\n".join(lines)
-                send_telegram(chat_id, message)
-                mark_seen(listing['id'], listing['title'], listing['price'], listing['url'])
-                new_count += 1
-                time.sleep(0.3)
-
-        return new_count
+        seen_ids = get_seen_ids([listing.id for listing in listings])
+        candidates = [listing for listing in listings if listing.id not in seen_ids]
+
+        # Nomzodlarni yozib, faqat shu chaqiruvda qo'shilganlarini yangi deb hisoblaymiz
+        claimed = claim_listings([
+            (listing.id, listing.title, listing.price, listing.url)
+            for listing in candidates
+        ])
+        new_listings = [listing for listing in candidates if listing.id in claimed]
+        messages = []
+
+        # Yangi e'lonlarning batafsil ma'lumotlarini parallel olish
+        all_details = _detail_pool.map(fetch_details_safe, [listing.url for listing in new_listings])
+
+        for listing, details in zip(new_listings, all_details):
+            messages.append(format_listing(listing, details))
+
+        return messages
     except Exception as e:
         logger.error(f"Check error for {url}: {e}")
-        return 0
+        return []
+
+
+def chunk_messages(messages: List[str]) -> List[str]:
+    """Xabarlarni TG_MESSAGE_LIMIT dan oshmaydigan guruhlarga birlashtirish."""
+    separator = "\n\n━━━━━━━━━━\n\n"
+    chunks = []
+    current = []
+    size = 0
+    for message in messages:
+        added = len(message) + (len(separator) if current else 0)
+        if current and size + added > TG_MESSAGE_LIMIT:
+            chunks.append(separator.join(current))
+            current = []
+            added = len(message)
+            size = 0
+        current.append(message)
+        size += added
+    if current:
+        chunks.append(separator.join(current))
+    return chunks
 
 
 def check_all_urls():
@@ -450,23 +933,53 @@ def check_all_urls():
     if not filters:
         return
 
-    # Parallel tekshirish (max 10 ta thread)
-    max_workers = min(10, len(filters))
+    # Bir xil URL'ga obuna bo'lgan chatlarni guruhlash - har bir URL bir marta yuklanadi
+    url_to_chats = defaultdict(list)
+    for f in filters:
+        url_to_chats[f.url].append(f.chat_id)
+
+    # O'chirilgan filterlarni adaptiv interval jadvali va scraper keshlaridan tozalash
+    for url in list(_url_interval):
+        if url not in url_to_chats:
+            _url_interval.pop(url, None)
+            _next_check_at.pop(url, None)
+    scraper.forget_stale(url_to_chats)
+
+    # Parallel tekshirish (OLX so'rovlari OLX_MAX_INFLIGHT bilan cheklangan)
+    now = time.monotonic()
+    futures = {}
+    for url, chat_ids in url_to_chats.items():
+        if _next_check_at.get(url, 0) > now:
+            continue
+        future = _filter_pool.submit(process_single_filter, url)
+        futures[future] = url
+
+    # Har bir chat uchun shu tsikldagi barcha yangi e'lonlar
+    pending = defaultdict(list)
+    total_new = 0
+    for future in as_completed(futures):
+        url = futures[future]
+        count = 0
+        try:
+            messages = future.result()
+            count = len(messages)
+            total_new += count
+            if messages:
+                for chat_id in url_to_chats[url]:
+                    pending[chat_id].extend(messages)
+        except Exception as e:
+            logger.error(f"Future error for {url}: {e}")
 
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = {}
-        for f in filters:
-            future = executor.submit(process_single_filter, f['chat_id'], f['url'])
-            futures[future] = f['url']
+        if count:
+            interval = CHECK_INTERVAL
+        else:
+            interval = min(_url_interval.get(url, CHECK_INTERVAL) * 2, MAX_CHECK_INTERVAL)
+        _url_interval[url] = interval
+        _next_check_at[url] = now + interval
 
-        total_new = 0
-        for future in as_completed(futures):
-            url = futures[future]
-            try:
-                count = future.result()
-                total_new += count
-            except Exception as e:
-                logger.error(f"Future error for {url}: {e}")
+    # Bir nechta e'lonni bitta xabarga birlashtirib yuborish (chatlar parallel)
+    for chat_id, messages in pending.items():
+        send_queue.put((chat_id, chunk_messages(messages)))
 
     if total_new > 0:
         logger.info(f"Jami {total_new} ta yangi e'lon topildi")
@@ -475,11 +988,20 @@ def check_all_urls():
 def checker_loop():
     """Background checker loop."""
     logger.info("Checker started")
+    last_prune = None
     while True:
         try:
             check_all_urls()
         except Exception as e:
             logger.error(f"Checker error: {e}")
+
+        if last_prune is None or time.monotonic() - last_prune >= PRUNE_INTERVAL:
+            try:
+                deleted = prune_seen_listings()
+                logger.info(f"{deleted} ta eski e'lon o'chirildi")
+            except Exception as e:
+                logger.error(f"Prune error: {e}")
+            last_prune = time.monotonic()
         time.sleep(CHECK_INTERVAL)
 
 
@@ -492,21 +1014,30 @@ def main():
 
     logger.info("Starting OLX Bot...")
 
-    # Delete any existing webhook
-    try:
-        requests.post(f"https://api.telegram.org/bot{BOT_TOKEN}/deleteWebhook")
-        logger.info("Webhook deleted")
-    except:
-        pass
+    if not WEBHOOK_URL:
+        # Delete any existing webhook
+        try:
+            tg_session.post(f"{TG_BASE}/deleteWebhook", timeout=30)
+            logger.info("Webhook deleted")
+        except:
+            pass
 
     init_db()
 
+    # Start Telegram sender threads (har biri bitta chat xabarlarini yuboradi)
+    for _ in range(TG_SENDER_WORKERS):
+        threading.Thread(target=telegram_sender_loop, daemon=True).start()
+    logger.info(f"Telegram senders started ({TG_SENDER_WORKERS})")
+
     # Start checker thread
     checker_thread = threading.Thread(target=checker_loop, daemon=True)
     checker_thread.start()
 
-    # Run polling (main thread)
-    polling_loop()
+    # Run webhook server or polling (main thread)
+    if WEBHOOK_URL:
+        webhook_loop()
+    else:
+        polling_loop()
 
 
 if __name__ == '__main__':